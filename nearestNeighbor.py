@@ -2,7 +2,30 @@ import numpy as np
 import networkx as nx
 from matplotlib import pyplot as plt
 import csv
-
+import os
+from pathlib import Path
+from scipy.sparse import csr_array
+from scipy.sparse.csgraph import dijkstra
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+#numba is optional, without it the distance table falls back to scipy's dijkstra
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+#regions used to partition the rest homes, keyed by the name used for the output files
+REGIONS = {
+    "1": 'Auckland Isthmus',
+    "2": 'North Shore',
+    "3": 'South Auckland',
+    "4": 'West Auckland',
+}
+
+#regions with at most this many homes (not counting the start) get an exact tour from held_karp,
+#larger ones use the nearest neighbor algorithm. without numba the dynamic program runs in python,
+#so the limit is lower.
+HELD_KARP_MAX_HOMES = 20 if njit is not None else 12
 
 def read_network(filename):
     """ Reads in a file to a netowrkx.Graph object
@@ -17,6 +40,12 @@ def read_network(filename):
     network : networkx.Graph
         representation of the file as a graph/network
 
+    Notes
+    -----
+    network.graph also holds 'nodes' (list of node names), 'node_idx' (node name to index),
+    'csr' (scipy sparse adjacency matrix of edge weights in the order of 'nodes')
+    and 'lat', 'lng' (arrays of node coordinates in the order of 'nodes').
+
     """
 
     network = nx.read_graphml(filename)
@@ -26,7 +55,89 @@ def read_network(filename):
             return int(x)
         except ValueError:
             return x
-    nx.relabel_nodes(network, relabeller, copy=False)
+    # build the whole mapping in one pass and relabel into a new graph, relabelling in place
+    # removes and re-adds every node with its edges, which is much slower for this many nodes.
+    mapping = {n: relabeller(n) for n in network.nodes}
+    network = nx.relabel_nodes(network, mapping, copy=True)
+
+    # fix a node order and store the network as a sparse adjacency matrix
+    # for the scipy shortest path routines
+    node_list = list(network.nodes)
+    csr = nx.to_scipy_sparse_array(network, nodelist=node_list, weight='weight', format='csr')
+    index_network(network, node_list, csr)
+    return network
+
+def index_network(network, node_list, csr):
+    """ store the node order, sparse adjacency matrix and node coordinates of a network in network.graph
+
+    Parameters
+    ----------
+    network : networkx.Graph
+        representation of the file as a graph/network
+    node_list : list
+        names of all nodes in the network, in the order of the rows of csr
+    csr : scipy.sparse.csr_array
+        adjacency matrix of edge weights
+    """
+    network.graph['nodes'] = node_list
+    network.graph['node_idx'] = {n: i for i, n in enumerate(node_list)}
+    network.graph['csr'] = csr
+    # coordinates as contiguous arrays so paths can be looked up by index instead of per node dicts
+    network.graph['lat'] = np.fromiter((network.nodes[n]['lat'] for n in node_list), dtype=np.float64, count=len(node_list))
+    network.graph['lng'] = np.fromiter((network.nodes[n]['lng'] for n in node_list), dtype=np.float64, count=len(node_list))
+
+def read_network_cached(filename):
+    """ Reads in a graphml file like read_network, using a binary cache next to the file
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file to read. File should be in graphml format
+
+    Returns
+    -------
+    network : networkx.Graph
+        representation of the file as a graph/network, the same as read_network returns
+
+    Notes
+    -----
+    the first call parses the graphml file and saves the sparse adjacency matrix, node names and
+    coordinates to filename + '.npz'. later calls rebuild the network from those arrays, which is
+    much faster than parsing the xml. the cache is rebuilt if the graphml file is newer than it.
+    """
+    cache = filename + '.npz'
+
+    if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(filename):
+        network = read_network(filename)
+        node_list = network.graph['nodes']
+        csr = network.graph['csr']
+        # write to a temporary file first so other processes never read a half written cache
+        tmp = "{}.{}.tmp".format(cache, os.getpid())
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, indptr=csr.indptr, indices=csr.indices, data=csr.data,
+                     nodes=np.array(node_list, dtype=object),
+                     lats=network.graph['lat'], lngs=network.graph['lng'],
+                     directed=network.is_directed())
+        os.replace(tmp, cache)
+        return network
+
+    with np.load(cache, allow_pickle=True) as npz:
+        indptr, indices, data = npz['indptr'], npz['indices'], npz['data']
+        node_list = npz['nodes'].tolist()
+        lats, lngs = npz['lats'].tolist(), npz['lngs'].tolist()
+        directed = bool(npz['directed'])
+    n = len(node_list)
+    csr = csr_array((data, indices, indptr), shape=(n, n))
+
+    network = nx.DiGraph() if directed else nx.Graph()
+    network.add_nodes_from((node, {'lat': lat, 'lng': lng}) for node, lat, lng in zip(node_list, lats, lngs))
+    # each undirected edge is stored twice in csr, only add the upper triangle
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    keep = slice(None) if directed else rows <= indices
+    network.add_weighted_edges_from(
+        (node_list[u], node_list[v], w) for u, v, w in zip(rows[keep].tolist(), indices[keep].tolist(), data[keep].tolist()))
+
+    index_network(network, node_list, csr)
     return network
 
 def get_rest_homes(filename):
@@ -55,24 +166,33 @@ def plot_path(network, path, save=None):
     Parameters
     ----------
     network : networkx.Graph
-        The graph that contains the node and edge information
+        The graph that contains the node and edge information, as returned by read_network
     path : list
         A list of node names
     save: str or None
         If a string is provided, then saves the figure to the path given by the string
         If None, then displays the figure to the screen
     """
-    lats = [network.nodes[p]['lat'] for p in path]
-    lngs = [network.nodes[p]['lng'] for p in path]
-    plt.figure(figsize=(8,6))
+    node_idx = network.graph['node_idx']
+    idx = np.fromiter((node_idx[p] for p in path), dtype=np.int64, count=len(path))
+    lats = network.graph['lat'][idx]
+    lngs = network.graph['lng'][idx]
+    fig = plt.figure(figsize=(8,6))
     ext = [174.48866, 175.001869, -37.09336, -36.69258]
-    plt.imshow(plt.imread("akl_zoom.png"), extent=ext)
+    plt.imshow(_basemap(), extent=ext)
     plt.plot(lngs, lats, 'r.-')
     if save:
         plt.savefig(save, dpi=300)
+        # release the figure, otherwise every saved plot stays open
+        plt.close(fig)
     else:
         plt.show()
 
+@lru_cache(maxsize=1)
+def _basemap():
+    """ decode the Auckland background image once, it is reused by every call to plot_path """
+    return plt.imread("akl_zoom.png")
+
 def save_data(name,data):
     """ save data as a txt file
 
@@ -91,13 +211,8 @@ def save_data(name,data):
     -----
     name should NOT include ".txt" at the end
     """ 
-    #write to a file with the specified name and add .txt to string
-    f=open(name + ".txt",'w')
-
-    for p in data:
-        f.write(str(p) + '\n')
-
-    f.close()
+    #write to a file with the specified name and add .txt to string, one item per line in a single write
+    Path(name + ".txt").write_text(''.join(str(p) + '\n' for p in data))
 
 def load_data(name):
     """ load data from a txt file
@@ -116,21 +231,12 @@ def load_data(name):
     -----
     name should NOT include ".txt" at the end
     """ 
-    #write to a file with the specified name and add .txt to string
-    with open(name + ".txt") as f:
-        #initialize empty array
-        data = []
-        #initialize arbitrary value for ln
-        ln = 0
-        #read lines in file until all lines are read and record that information
-        while ln != '':
-            ln = f.readline().strip()
-            data.append(ln)
-        
+    #read the whole file with the specified name and add .txt to string, then split it into lines
+    data = [ln.strip() for ln in Path(name + ".txt").read_text().splitlines()]
     
     return data
 
-def shortest_path_length(network, a, b, distance = True):
+def shortest_path_length(network, a, b, distance = True, astar = False):
     """ find shorest distance/path between two nodes
 
     Parameters
@@ -147,6 +253,9 @@ def shortest_path_length(network, a, b, distance = True):
     distance : bool
         whether to return distance or path
 
+    astar : bool
+        whether to use an A* search with a great-circle heuristic instead of a bidirectional dijkstra
+
     Returns
     -------
     dist : float
@@ -157,19 +266,556 @@ def shortest_path_length(network, a, b, distance = True):
     Notes
     -----
     distance is defulted to True, i.e. min distance is returned by defult.
+    results are memoized per network, see _shortest_path_cached.
+    astar is defulted to False: edge weights are travel times, so the heuristic is the great-circle
+    distance at the fastest speed on the network, about twice the typical speed. on the auckland
+    network the A* search is faster than a one way dijkstra but slower than the bidirectional one.
     """  
 
+    #distances and paths on an undirected network are symmetric so (a,b) and (b,a) share a cache entry.
+    #nodes can be a mix of ints and strings, so order them by their string form.
+    swapped = False
+    if not network.is_directed() and str(b) < str(a):
+        a, b = b, a
+        swapped = True
+
     if distance:
-        return nx.shortest_path_length(network,a,b,weight = 'weight')
+        return _shortest_path_cached(network, a, b, astar)[0]
     elif not distance:
-        return nx.shortest_path(network,a,b,weight = 'weight')
+        #copy the cached path so callers cannot modify it, reversing it if the pair was swapped
+        path = _shortest_path_cached(network, a, b, astar)[1]
+        return path[::-1] if swapped else list(path)
     #if distance is not valid return nothing
     return None
+
+@lru_cache(maxsize = None)
+def _shortest_path_cached(network, a, b, astar):
+    """ memoized bidirectional dijkstra or A* search behind shortest_path_length
+
+    Returns
+    -------
+    dist : float
+        shorest distance between the two nodes
+    path : list
+        list of nodes taken for shorest path
+
+    Notes
+    -----
+    a single search gives both the distance and the path.
+    networkx graphs hash by identity, so each network gets its own cache entries.
+    call _shortest_path_cached.cache_clear() if a network is modified after it has been queried.
+    """
+    if not astar:
+        return nx.bidirectional_dijkstra(network,a,b,weight = 'weight')
+
+    #lower bound on the distance from every node to b, see heuristic_to
+    lower = heuristic_to(network, b).tolist()
+    node_idx = network.graph['node_idx']
+    path = nx.astar_path(network, a, b, heuristic = lambda u, v: lower[node_idx[u]], weight = 'weight')
+    return nx.path_weight(network, path, 'weight'), path
+
+def haversine(lat1, lng1, lat2, lng2):
+    """ great-circle distance between points given in degrees
+
+    Parameters
+    ----------
+    lat1, lng1, lat2, lng2 : float or numpy.ndarray
+        coordinates of the two points, arrays are broadcast against each other
+
+    Returns
+    -------
+    dist : float or numpy.ndarray
+        distance between the points in km
+    """
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lng2 - lng1)/2)**2
+    return 2*6371.0088*np.arcsin(np.sqrt(a))
+
+@lru_cache(maxsize = None)
+def _weight_per_km(network):
+    """ smallest edge weight per km of great-circle distance over the whole network
+
+    Notes
+    -----
+    edge weights are travel times, so this is one over the fastest speed on the network.
+    scaling the great-circle distance by it never overestimates the weight of a path.
+    """
+    csr = network.graph['csr']
+    lat, lng = network.graph['lat'], network.graph['lng']
+    rows = np.repeat(np.arange(csr.shape[0]), np.diff(csr.indptr))
+    km = haversine(lat[rows], lng[rows], lat[csr.indices], lng[csr.indices])
+    #edges between nodes at the same point put no bound on the speed
+    moved = km > 0
+    return float(np.min(csr.data[moved] / km[moved]))
+
+def heuristic_to(network, b):
+    """ lower bound on the shortest distance from every node in the network to b
+
+    Parameters
+    ----------
+    network : networkx.Graph
+        representation of the file as a graph/network, as returned by read_network
+    
+    b : string
+        name of 'to' node
+
+    Returns
+    -------
+    lower : numpy.ndarray
+        lower bound for each node, in the order of network.graph['nodes']
+    """
+    lat, lng = network.graph['lat'], network.graph['lng']
+    i = network.graph['node_idx'][b]
+    #shrink slightly so rounding can never make the bound overestimate
+    return haversine(lat, lng, lat[i], lng[i]) * _weight_per_km(network) * (1 - 1e-9)
     
 
     
+def path_from_predecessors(network, preds, a, b):
+    """ rebuild the shortest path between two nodes from a dijkstra predecessor array
+
+    Parameters
+    ----------
+    network : networkx.Graph
+        representation of the file as a graph/network, as returned by read_network
+    
+    preds : list
+        predecessor index of each node, one row of the predecessors returned by scipy's dijkstra
+    
+    a : string
+        name of 'from' node, i.e. the source of the dijkstra
+    
+    b : string
+        name of 'to' node
+
+    Returns
+    -------
+    path : list
+        list of nodes taken for shorest path
+    """
+    nodes = network.graph['nodes']
+    node_idx = network.graph['node_idx']
+    source = node_idx[a]
+
+    path = [node_idx[b]]
+    while path[-1] != source:
+        prev = preds[path[-1]]
+        #scipy marks nodes with no predecessor with a negative index
+        if prev < 0:
+            raise nx.NetworkXNoPath("No path between {} and {}.".format(a, b))
+        path.append(prev)
+    return [nodes[i] for i in reversed(path)]
+
+if njit is not None:
+    @njit(cache=True)
+    def _dijkstra_one(indptr, indices, weights, source, dist, pred):
+        """ dijkstra from a single source over a csr graph, see dijkstra_batch
+
+        Notes
+        -----
+        dist and pred are filled in place. a binary heap is kept in two arrays,
+        stale entries are skipped when popped instead of being decreased in place.
+        """
+        n = dist.shape[0]
+        visited = np.zeros(n, np.bool_)
+        #every successful relaxation pushes at most one entry, plus one for the source
+        cap = indices.shape[0] + 1
+        heap_d = np.empty(cap, np.float64)
+        heap_v = np.empty(cap, np.int64)
+
+        dist[source] = 0.0
+        heap_d[0] = 0.0
+        heap_v[0] = source
+        size = 1
+        while size > 0:
+            #pop the root, then move the last entry to the root and sift it down
+            d = heap_d[0]
+            u = heap_v[0]
+            size -= 1
+            if size > 0:
+                last_d = heap_d[size]
+                last_v = heap_v[size]
+                i = 0
+                while True:
+                    c = 2*i + 1
+                    if c >= size:
+                        break
+                    if c + 1 < size and heap_d[c+1] < heap_d[c]:
+                        c += 1
+                    if heap_d[c] < last_d:
+                        heap_d[i] = heap_d[c]
+                        heap_v[i] = heap_v[c]
+                        i = c
+                    else:
+                        break
+                heap_d[i] = last_d
+                heap_v[i] = last_v
+
+            if visited[u]:
+                continue
+            visited[u] = True
+
+            for e in range(indptr[u], indptr[u+1]):
+                v = indices[e]
+                nd = d + weights[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    pred[v] = u
+                    #push the new entry and sift it up
+                    i = size
+                    size += 1
+                    while i > 0:
+                        p = (i - 1) // 2
+                        if heap_d[p] > nd:
+                            heap_d[i] = heap_d[p]
+                            heap_v[i] = heap_v[p]
+                            i = p
+                        else:
+                            break
+                    heap_d[i] = nd
+                    heap_v[i] = v
+
+    @njit(parallel=True, cache=True)
+    def dijkstra_batch(indptr, indices, weights, sources, n):
+        """ run dijkstra from several sources in parallel over a csr graph
+
+        Parameters
+        ----------
+        indptr, indices, weights : numpy.ndarray
+            arrays of a scipy csr adjacency matrix
+        
+        sources : numpy.ndarray
+            indices of the source nodes
+        
+        n : int
+            number of nodes in the graph
+
+        Returns
+        -------
+        D : numpy.ndarray
+            (len(sources), n) array of shortest distances from each source
+        P : numpy.ndarray
+            (len(sources), n) array of predecessor indices, -9999 where there is none (same as scipy)
+        """
+        k = sources.shape[0]
+        D = np.full((k, n), np.inf)
+        P = np.full((k, n), -9999, np.int32)
+        for s in prange(k):
+            _dijkstra_one(indptr, indices, weights, sources[s], D[s], P[s])
+        return D, P
+
+def build_distance_table(network, nodes, need_path = True):
+    """ find the shortest distances and paths between every pair of nodes in a list
+
+    Parameters
+    ----------
+    network : networkx.Graph
+        representation of the file as a graph/network, as returned by read_network
+    
+    nodes : list
+        names of the nodes to include in the table
+
+    need_path : bool
+        whether to also find the paths, which are only needed for plotting
+
+    Returns
+    -------
+    D : numpy.ndarray
+        (len(nodes), len(nodes)) array, D[i,j] is the shortest distance from nodes[i] to nodes[j]
+    paths : dict or None
+        paths[(i,j)] is the list of nodes taken for the shortest path from nodes[i] to nodes[j],
+        None if need_path is False
+
+    Notes
+    -----
+    the searches from all the nodes are done in one batch, by dijkstra_batch when numba is
+    installed and by scipy's dijkstra otherwise, so the tour itself never has to search the network.
+    """
+    k = len(nodes)
+    node_idx = network.graph['node_idx']
+    csr = network.graph['csr']
+    idx = np.array([node_idx[n] for n in nodes])
+
+    #dist and preds have one row per node in the list and one column per node in the network
+    if njit is not None:
+        dist, preds = dijkstra_batch(csr.indptr, csr.indices, csr.data, idx, csr.shape[0])
+    else:
+        dist, preds = dijkstra(csr, indices = idx, return_predecessors = True)
+    D = dist[:, idx]
+
+    #rebuilding the paths is most of the work on top of the search, so skip it when not needed
+    if not need_path:
+        return D, None
+
+    paths = {}
+    for i in range(k):
+        row = preds[i].tolist()
+        for j in range(k):
+            paths[(i,j)] = path_from_predecessors(network, row, nodes[i], nodes[j])
+
+    return D, paths
             
-def nearest_neighbor(network,homes):
+def nn_tour(D, start_idx = 0):
+    """ order the homes of a distance table with the nearest neighbor algorithm
+
+    Parameters
+    ----------
+    D : numpy.ndarray
+        (k, k) array of shortest distances between homes, as returned by build_distance_table
+    
+    start_idx : int
+        index of the home the tour starts and ends at
+
+    Returns
+    -------
+    order : list
+        indices of the homes in the order they are visited, starting and ending at start_idx
+
+    Notes
+    -----
+    _nn_tour_jit is used instead when numba is installed, see nearest_neighbor_on_table.
+    """
+    #initialize the current node, which will always be auckland airport
+    #and mark it as visited
+    curr_idx = start_idx
+    order = [start_idx]
+    alive = np.ones(D.shape[0], dtype = bool)
+    alive[start_idx] = False
+
+    #added to each row of distances so visited homes can never be the minimum
+    penalty = np.zeros(D.shape[0], dtype = np.float64)
+    penalty[start_idx] = np.inf
+
+    #buffer for the distances of each step, allocated once and reused
+    dist_buf = np.empty(D.shape[0], dtype = np.float64)
+
+    #loop until all homes have been visited
+    for _ in range(D.shape[0] - 1):
+        #distances from the current node to every home, with the visited ones set to inf,
+        #so a single argmin over the whole row finds the nearest home not vistited yet.
+        all_dist = np.add(D[curr_idx], penalty, out = dist_buf)
+        curr_idx = int(all_dist.argmin())
+
+        #if only unreachable homes are left every entry is inf, take the first one not visited
+        if not alive[curr_idx]:
+            curr_idx = int(np.flatnonzero(alive)[0])
+
+        #mark the city with min distance as visited
+        alive[curr_idx] = False
+        penalty[curr_idx] = np.inf
+        order.append(curr_idx)
+
+    #return to the starting point to complete the tour, unless there was nowhere to go
+    if len(order) > 1:
+        order.append(start_idx)
+    return order
+
+if njit is not None:
+    @njit(cache=True)
+    def _nn_tour_jit(D, start_idx):
+        """ compiled version of nn_tour, returns the order as an array """
+        k = D.shape[0]
+        if k == 1:
+            return np.full(1, start_idx, np.int64)
+        order = np.empty(k + 1, np.int64)
+        alive = np.ones(k, np.bool_)
+        order[0] = start_idx
+        alive[start_idx] = False
+        cur = start_idx
+        for step in range(1, k):
+            #first unvisited home with the smallest distance, same tie break as argmin
+            best = -1
+            bd = np.inf
+            for j in range(k):
+                if alive[j] and (best < 0 or D[cur, j] < bd):
+                    bd = D[cur, j]
+                    best = j
+            order[step] = best
+            alive[best] = False
+            cur = best
+        order[k] = start_idx
+        return order
+
+def tour_from_order(D, paths, order):
+    """ find the distances and full path of a tour visiting the homes of a distance table in order
+
+    Parameters
+    ----------
+    D : numpy.ndarray
+        (k, k) array of shortest distances between homes, as returned by build_distance_table
+    
+    paths : dict or None
+        paths[(i,j)] is the list of nodes taken from home i to home j, as returned by build_distance_table.
+        if None, path_homes_full is not built
+    
+    order : list
+        indices of the homes in the order they are visited
+
+    Returns
+    -------
+    dist_min : list
+        list of shortest distances between a pair of nodes
+    path_idx : list
+        list of indices of the homes taken in oreder, that were taken for shorest tour.
+    path_homes_full : list
+        list of homes and bus-stops taken in oreder, that were taken for shorest tour.
+    """
+    path_idx = [int(i) for i in order]
+    steps = list(zip(path_idx[:-1], path_idx[1:]))
+
+    #distance of each step
+    dist_min = [float(D[i, j]) for i, j in steps]
+
+    #path, for path plot that contains all bus-stops
+    path_homes_full = []
+    if paths is not None:
+        for s, (i, j) in enumerate(steps):
+            if s < len(steps) - 2:
+                #remove the end node as it will included as the first node in the next step
+                path_homes_full.append(paths[(i, j)][0:-1])
+            else:
+                #the steps to the last home and back to the start record their end node.
+                path_homes_full.append(paths[(i, j)])
+
+    return dist_min, path_idx, path_homes_full
+
+def _held_karp_dp(D, start_idx):
+    """ dynamic program behind held_karp, returns the order as an array
+
+    Notes
+    -----
+    dp[mask, i] is the shortest path from the start through the homes in mask ending at home i,
+    where the homes other than the start are numbered 0..m-1. compiled with numba when installed.
+    an empty order is returned if no tour with a finite distance exists, e.g. a home is unreachable.
+    """
+    k = D.shape[0]
+    m = k - 1
+    others = np.empty(m, np.int64)
+    c = 0
+    for i in range(k):
+        if i != start_idx:
+            others[c] = i
+            c += 1
+
+    full = (1 << m) - 1
+    dp = np.full((1 << m, m), np.inf)
+    parent = np.full((1 << m, m), -1, np.int8)
+    for i in range(m):
+        dp[1 << i, i] = D[start_idx, others[i]]
+
+    #masks only grow, so every state is final before it is extended
+    for mask in range(1, full + 1):
+        for i in range(m):
+            if not (mask >> i) & 1 or dp[mask, i] == np.inf:
+                continue
+            for j in range(m):
+                if (mask >> j) & 1:
+                    continue
+                new = dp[mask, i] + D[others[i], others[j]]
+                nxt = mask | (1 << j)
+                if new < dp[nxt, j]:
+                    dp[nxt, j] = new
+                    parent[nxt, j] = i
+
+    #close the tour back at the start
+    last = 0
+    best = np.inf
+    for i in range(m):
+        total = dp[full, i] + D[others[i], start_idx]
+        if total < best:
+            best = total
+            last = i
+
+    #every tour has an inf step, so there are no parents to walk back
+    if best == np.inf:
+        return np.empty(0, np.int64)
+
+    #walk the parents back from the last home
+    order = np.empty(k + 1, np.int64)
+    order[0] = start_idx
+    order[k] = start_idx
+    mask = full
+    for step in range(m, 0, -1):
+        order[step] = others[last]
+        prev = int(parent[mask, last])
+        mask ^= 1 << last
+        #only the first home after the start has no parent
+        if prev < 0:
+            if step != 1:
+                return np.empty(0, np.int64)
+            break
+        last = prev
+    return order
+
+if njit is not None:
+    _held_karp_dp = njit(cache=True)(_held_karp_dp)
+
+def held_karp(D, start_idx = 0):
+    """ order the homes of a distance table into the shortest possible tour
+
+    Parameters
+    ----------
+    D : numpy.ndarray
+        (k, k) array of shortest distances between homes, as returned by build_distance_table
+    
+    start_idx : int
+        index of the home the tour starts and ends at
+
+    Returns
+    -------
+    order : list
+        indices of the homes in the order they are visited, starting and ending at start_idx
+
+    Notes
+    -----
+    the held-karp dynamic program is exact but takes O(2^k k^2) time and O(2^k k) memory,
+    so it is only used for small regions, see HELD_KARP_MAX_HOMES.
+    raises networkx.NetworkXNoPath if there is no tour with a finite distance.
+    """
+    if D.shape[0] == 1:
+        return [start_idx]
+    order = _held_karp_dp(np.ascontiguousarray(D, dtype = np.float64), start_idx)
+    if len(order) == 0:
+        raise nx.NetworkXNoPath("No tour with a finite distance visits every home.")
+    return order.tolist()
+
+def nearest_neighbor_on_table(D, paths, start_idx = 0):
+    """ A tour is construced using the nearest neighbor algorithm on a precomputed distance table
+
+    Parameters
+    ----------
+    D : numpy.ndarray
+        (k, k) array of shortest distances between homes, as returned by build_distance_table
+    
+    paths : dict or None
+        paths[(i,j)] is the list of nodes taken from home i to home j, as returned by build_distance_table.
+        if None, path_homes_full is not built
+    
+    start_idx : int
+        index of the home the tour starts and ends at
+
+    Returns
+    -------
+    dist_min : list
+        list of shortest distances between a pair of nodes
+    path_idx : list
+        list of indices of the homes taken in oreder, that were taken for shorest tour.
+    path_homes_full : list
+        list of homes and bus-stops taken in oreder, that were taken for shorest tour.
+
+    Notes
+    -----
+    only table lookups are done, the network is never searched.
+    the order is found by _nn_tour_jit when numba is installed and by nn_tour otherwise.
+    """  
+    if njit is not None:
+        order = _nn_tour_jit(np.ascontiguousarray(D), start_idx)
+    else:
+        order = nn_tour(D, start_idx)
+
+    return tour_from_order(D, paths, order)
+
+def nearest_neighbor(network,homes,need_path = True):
     """ A tour is construced using the nearest neighbor algorithm
 
     Parameters
@@ -180,81 +826,33 @@ def nearest_neighbor(network,homes):
     homes : list
         names of homes that should be included in the tour
 
+    need_path : bool
+        whether to build path_homes_full, which is only needed for plotting
+
     Returns
     -------
     dist_min : list
         list of shortest distances between a pair of nodes
     path_homes_full : list
         list of homes and bus-stops taken in oreder, that were taken for shorest tour.
+        empty if need_path is False
     path_homes : list
         list of homes taken in oreder, that were taken for shorest tour.    
 
     Notes
     -----
+    the tour starts and ends at the first home, i.e. auckland airport.
+    see build_distance_table and nearest_neighbor_on_table.
     """  
-    #initialize empty lists
-    dist_min = []
-    path_homes = []
-    path_homes_full = []
-
-    #initialize the current node, which will always be auckland airport
-    #and remove it from the list
-    curr_node = homes[0]
-    homes.remove(curr_node)
-
-    #save the starting node to append at the end
-    auk_airpot = curr_node
-
-    #initialize a bool to indicate when to return to starting node
-    going_back = False
-
-    #loop while not all homes have been visited
-    while not homes == []:
-        #initialize empty list that will contain all the distance from current node to all
-        #other nodes in the homes list
-        all_dist = []
-
-        #get all distances by finding the distance from the current node to the every other node in the region
-        #that has not been vistited yet.
-        for i in range(len(homes)):
-            all_dist.append(shortest_path_length(network, curr_node, homes[i], distance = True))
-        
-        #find index of min distance, this will correspond to the index of the city
-        min_index = np.argmin(all_dist)
-
-        #record the information of nearest city
-        #distance
-        dist_min.append(all_dist[min_index])
-        #home, for text file output 
-        path_homes.append(curr_node)
-        #path, for path plot that contains all bus-stops
-        if len(homes) != 1:
-            #if we are not returning then remove the end node as it will included as the first node in the next cycle
-            path_homes_full.append(shortest_path_length(network, curr_node, homes[min_index], distance = False)[0:-1])
-        else:
-            #if this is the last cycle then record that node.
-            path_homes_full.append(shortest_path_length(network, curr_node, homes[min_index], distance = False))
-
-        #update current node, with the city with min distance
-        curr_node = homes[min_index] 
-
-        
-        #if the last node has been visited then add the starting point to complete the tour.
-        if going_back == False and len(homes) == 1:
-            going_back = True
-            homes.append('Auckland Airport')  
-        
-        #remove the current node from the list as it has been visited
-        homes.remove(curr_node)
-
-    #append auckland airport since the tour always returns to that node
-    path_homes.append(auk_airpot)
+    D, paths = build_distance_table(network, homes, need_path)
+    dist_min, path_idx, path_homes_full = nearest_neighbor_on_table(D, paths, 0)
+    path_homes = [homes[i] for i in path_idx]
 
     return dist_min, path_homes, path_homes_full  
 
 
-def solve_region(network,region,region_name,save_distance = False):
-    """ A tour is construced using the nearest neighbor algorithm
+def solve_region(network,region,region_name,save_distance = False,plot = True):
+    """ A tour is construced using held_karp for small regions and the nearest neighbor algorithm otherwise
 
     Parameters
     ----------
@@ -269,9 +867,13 @@ def solve_region(network,region,region_name,save_distance = False):
 
     save_distance : bool
         a bool variable that determines if distances should be saved
+
+    plot : bool
+        a bool variable that determines if the png of the path should be generated
     Returns
     -------
-    None
+    total : float
+        total distance of the tour
 
     Notes
     -----
@@ -280,10 +882,30 @@ def solve_region(network,region,region_name,save_distance = False):
         2.) path_'region_name'.txt contains the path taken, only home names.
         3.) path_'region_name'.png is an image of exact path taken i.e. home names and bus-stops.
     
+    regions with at most HELD_KARP_MAX_HOMES homes (not counting auckland airport) get the exact
+    shortest tour from held_karp, larger regions and regions where some home is unreachable use
+    nearest_neighbor_on_table. the four auckland regions are all larger, so they use nearest neighbor.
     save_distance is defulted to false
+    plot is defulted to true, if false the png is not made and the full paths are never computed
     """  
-    #find distances and path of shortest tour.
-    region_dists, region_path, region_path_full = nearest_neighbor(network,region)
+    #find distances and paths between all homes once, the tour is then only table lookups
+    #note the full paths are only needed for the plot
+    D, paths = build_distance_table(network, region, need_path = plot)
+
+    #find distances and path of shortest tour, starting from auckland airport.
+    #small regions are solved exactly, the rest use the nearest neighbor algorithm
+    order = None
+    if len(region) - 1 <= HELD_KARP_MAX_HOMES:
+        try:
+            order = held_karp(D, 0)
+        except nx.NetworkXNoPath:
+            #some home is unreachable, the nearest neighbor tour still visits every home
+            order = None
+    if order is not None:
+        region_dists, region_idx, region_path_full = tour_from_order(D, paths, order)
+    else:
+        region_dists, region_idx, region_path_full = nearest_neighbor_on_table(D, paths, 0)
+    region_path = [region[i] for i in region_idx]
     
     # change from list of lists to list i.e. flatten the 2-D list to 1-D
     flat_region_path_full = [item for sublist in region_path_full for item in sublist]
@@ -294,15 +916,30 @@ def solve_region(network,region,region_name,save_distance = False):
         save_data("distances_"+ region_name, region_dists)
 
 
-    print(sum(region_dists))
     save_data("path_" + region_name,region_path)
 
     #generate png
-    plot_path(network,flat_region_path_full,"path_" + region_name + ".png")
+    if plot:
+        plot_path(network,flat_region_path_full,"path_" + region_name + ".png")
 
+    return sum(region_dists)
 
 
 
+#network loaded once in each worker process by _init_worker
+_worker_network = None
+
+def _init_worker(filename):
+    """ load the network into a worker process, see main """
+    global _worker_network
+    _worker_network = read_network_cached(filename)
+
+def _solve_one(job):
+    """ solve a single (region, region_name) job with the worker's network and return its total distance, see main """
+    region, region_name = job
+    return solve_region(_worker_network,region,region_name,save_distance= False)
+
+
 def main():
 
     #------Import homes and region data and parition criteria------#
@@ -317,50 +954,29 @@ def main():
     #   4.) West Auckland
 
     #import data
-    #initialize empty lists
-    region = []
-    rest_homes = []
-    #read all data and place into a list
+    #read all data and split it into columns
     data = np.genfromtxt('data_region.csv', delimiter= ',', skip_header= True, dtype= str)
-    #loop through list and append data into lists
-    for row in data:
-        region.append(row[2])
-        rest_homes.append(row[0])
-    
+    homes_arr = data[:,0]
+    regions_arr = data[:,2]
 
-    #The data is ordered so we can split it without conditions.
+    #select the homes of each region with a boolean mask, so the data does not need to be ordered.
     #note auckland airport is added to all regions, as it is a starting point.
-    auk_airport = ['Auckland Airport']
-    n = len(region)
-
-    #Auckland Isthmus region
-    search = 'Auckland Isthmus'
-    AI = auk_airport + rest_homes[region.index(search) : n - region[::-1].index(search)]
-
-    #North shore region
-    search = 'North Shore'
-    NS = auk_airport + rest_homes[region.index(search) : n - region[::-1].index(search)]
-
-    #South Auckland region
-    search = 'South Auckland'
-    SA = auk_airport + rest_homes[region.index(search) : n - region[::-1].index(search)]
-
-    #West auckland region
-    search = 'West Auckland'
-    WA = auk_airport + rest_homes[region.index(search) : n - region[::-1].index(search)]
+    groups = {name: ['Auckland Airport'] + homes_arr[regions_arr == region].tolist() for name, region in REGIONS.items()}
 
 
     #---------------Construct Tours for each region and save data---------------#
 
-    #load graph data
-    auckland = read_network('network.graphml')
-
+    #the regions are independent so each tour is solved in its own process.
+    #every worker loads the graph data itself, which is cheaper than pickling the networkx graph to it.
+    jobs = [(homes, name) for name, homes in groups.items()]
 
     #create tour for each region and save data as described in function documentation
-    solve_region(auckland,AI,"1",save_distance= False)
-    solve_region(auckland,NS,"2",save_distance= False)
-    solve_region(auckland,SA,"3",save_distance= False)
-    solve_region(auckland,WA,"4",save_distance= False)
+    with ProcessPoolExecutor(max_workers= len(jobs), initializer= _init_worker, initargs= ('network.graphml',)) as ex:
+        totals = list(ex.map(_solve_one, jobs))
+
+    #map returns the results in the order of the jobs, so the totals are printed in region order
+    for total in totals:
+        print(total)
 
 
 if __name__ == "__main__":